@@ -1,11 +1,19 @@
 import os
 import json
+import functools
+import threading
+import collections
 import requests
 import faiss
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
 import streamlit as st
 import logging
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
 
 # Setup logging
@@ -19,39 +27,76 @@ logging.basicConfig(
 CACHE_DIR = "MTGCacheAllCards"
 EMBED_MODEL = "text-embedding-ada-002"
 SIMILARITY_THRESHOLD = 0.4
+TOP_K = 200
+INDEX_ADD_ROWS = 4096
+BATCH_MAX_QUERIES = 32
+SEARCH_TIMEOUT_SECONDS = 10
 
 GITHUB_RELEASE = "https://github.com/cfle/mtg_oracle/releases/download/v1.0"
 REQUIRED_FILES = {
     "cards.json": f"{GITHUB_RELEASE}/cards.json",
     "embeddings_trimmed.npy": f"{GITHUB_RELEASE}/embeddings_trimmed.npy",
-    "faiss_trimmed.index": f"{GITHUB_RELEASE}/faiss_trimmed.index",
 }
 
-def download_file(filename, url):
+COLOR_BITS = {"W": 1, "U": 2, "B": 4, "R": 8, "G": 16, "C": 32}
+
+SCRYFALL_API = "https://api.scryfall.com/"
+SCRYFALL_NAMED_URL = f"{SCRYFALL_API}cards/named"
+SCRYFALL_TIMEOUT = 3
+# Result tiles use Scryfall's 146x204 "small" scans drawn at native width so they
+# are never upscaled; the reference card keeps the full "normal" scan.
+IMAGE_SIZE = "small"
+IMAGE_WIDTH = 146
+REFERENCE_IMAGE_SIZE = "normal"
+
+@st.cache_resource(show_spinner=False)
+def get_session():
+    session = requests.Session()
+    # Release downloads retry; Scryfall lookups run under the search spinner, so
+    # they get no retries and SCRYFALL_TIMEOUT stays the real latency bound.
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=2))
+    session.mount(SCRYFALL_API, HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=0))
+    return session
+
+def download_file(filename, url, session):
     local_path = os.path.join(CACHE_DIR, filename)
     if not os.path.exists(local_path):
-        st.info(f"📦 Downloading `{filename}`...")
         os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{local_path}.tmp"
         try:
-            with requests.get(url, stream=True) as r:
+            with session.get(url, stream=True) as r:
                 r.raise_for_status()
-                with open(local_path, "wb") as f:
+                with open(tmp_path, "wb") as f:
                     for chunk in r.iter_content(chunk_size=8192):
                         f.write(chunk)
+            os.replace(tmp_path, local_path)
             logging.info(f"Downloaded {filename}")
         except Exception as e:
             logging.error(f"Failed to download {filename}: {e}")
             raise
 
 def validate_cache_files():
+    pending = {
+        filename: url
+        for filename, url in REQUIRED_FILES.items()
+        if not os.path.exists(os.path.join(CACHE_DIR, filename))
+    }
     missing = []
-    for filename, url in REQUIRED_FILES.items():
-        path = os.path.join(CACHE_DIR, filename)
-        if not os.path.exists(path):
-            try:
-                download_file(filename, url)
-            except Exception as e:
-                missing.append((filename, str(e)))
+    if pending:
+        # Worker threads have no script context, so report progress from here.
+        for filename in pending:
+            st.info(f"📦 Downloading `{filename}`...")
+        session = get_session()
+        with ThreadPoolExecutor(max_workers=len(pending)) as ex:
+            futures = {
+                filename: ex.submit(download_file, filename, url, session)
+                for filename, url in pending.items()
+            }
+            for filename, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    missing.append((filename, str(e)))
     if missing:
         st.error("🛑 Failed to download required files:")
         for fname, err in missing:
@@ -65,35 +110,188 @@ def fetch_cards():
             return json.load(f)
     except Exception as e:
         logging.exception("Failed to load cards.json")
-        st.error("❌ Failed to load card data.")
-        st.stop()
+        raise
+
+def get_image_uris(card):
+    image_uris = card.get("image_uris")
+    if not image_uris and card.get("card_faces"):
+        image_uris = card["card_faces"][0].get("image_uris")
+    return image_uris or {}
+
+def build_cards_parquet():
+    # Columnar copy of the fields the app reads, derived once from cards.json.
+    path = os.path.join(CACHE_DIR, "cards.parquet")
+    if not os.path.exists(path):
+        cards = fetch_cards()
+        table = pa.table({
+            "id": [c["id"] for c in cards],
+            "name": [c.get("name", "") for c in cards],
+            "color_identity": [c.get("color_identity", []) for c in cards],
+            "image_uris": [json.dumps(get_image_uris(c)) for c in cards],
+            "scryfall_uri": [c.get("scryfall_uri", "") for c in cards],
+        })
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        logging.info("Built cards.parquet")
+    return path
+
+@functools.lru_cache(maxsize=4096)
+def _name_pattern(name):
+    return re.compile(rf'\b{re.escape(name)}\b', re.IGNORECASE)
 
 def get_card_text(card):
     name = card.get("name", "")
     text = card.get("oracle_text", "")
     if name:
-        text = re.sub(rf'\b{re.escape(name)}\b', "this card", text, flags=re.IGNORECASE)
+        text = _name_pattern(name).sub("this card", text)
     keywords = " ".join(card.get("keywords", []))
     return f"{text} {keywords}".strip()
 
-@st.cache_data
+def encode_color_identity(identity):
+    if not identity:
+        return COLOR_BITS["C"]
+    bits = 0
+    for color in identity:
+        bits |= COLOR_BITS.get(color, 0)
+    return bits
+
+def build_fp16_embeddings():
+    # Normalized half-precision copy of the release embeddings, derived once per cache dir.
+    path = os.path.join(CACHE_DIR, "embeddings_trimmed_fp16.npy")
+    if not os.path.exists(path):
+        embeddings = np.ascontiguousarray(
+            np.load(os.path.join(CACHE_DIR, "embeddings_trimmed.npy")), dtype=np.float32
+        )
+        faiss.normalize_L2(embeddings)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, embeddings.astype(np.float16))
+        os.replace(tmp_path, path)
+        logging.info("Built embeddings_trimmed_fp16.npy")
+    return path
+
+# The loaders below, and the build helpers they call, raise instead of calling
+# st.stop(): a failure while preloading in the background is not cached and
+# resurfaces in main(), which owns the user-facing error.
+@st.cache_resource(show_spinner=False)
+def load_index():
+    embeddings = np.load(build_fp16_embeddings(), mmap_mode="r")
+    # Exact inner-product scan over fp16 codes, decoded by FAISS's SIMD kernels.
+    index = faiss.IndexScalarQuantizer(
+        embeddings.shape[1], faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+    )
+    for start in range(0, embeddings.shape[0], INDEX_ADD_ROWS):
+        index.add(np.asarray(embeddings[start:start + INDEX_ADD_ROWS], dtype=np.float32))
+    return index
+
+# Shared rather than copied per rerun: st.cache_data would pickle the
+# memory-mapped embeddings into a private in-RAM copy on every hit.
+@st.cache_resource(show_spinner=False)
 def load_data():
+    table = pq.read_table(
+        build_cards_parquet(),
+        columns=["id", "name", "color_identity", "image_uris", "scryfall_uri"],
+    )
+    # One flat array per rendered field, so drawing a result is a plain index.
+    cards = {
+        "name": np.array(table["name"].to_pylist(), dtype=object),
+        "image_url": np.array(
+            [json.loads(uris).get(IMAGE_SIZE) for uris in table["image_uris"].to_pylist()],
+            dtype=object,
+        ),
+        "scryfall_uri": np.array(table["scryfall_uri"].to_pylist(), dtype=object),
+    }
+    embeddings = np.load(build_fp16_embeddings(), mmap_mode="r")
+    id_to_idx = {card_id: i for i, card_id in enumerate(table["id"].to_pylist())}
+    color_bits = np.fromiter(
+        (encode_color_identity(identity) for identity in table["color_identity"].to_pylist()),
+        dtype=np.uint8,
+        count=table.num_rows,
+    )
+    return cards, embeddings, id_to_idx, color_bits
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_scryfall_card(name):
+    res = get_session().get(SCRYFALL_NAMED_URL, params={"fuzzy": name}, timeout=SCRYFALL_TIMEOUT)
+    # Only a definite "no such card" is cached; raising keeps 429/5xx replies out of the cache.
+    if res.status_code == 404:
+        return None
+    res.raise_for_status()
+    return res.json()
+
+class QueryBatcher:
+    # Sessions run in their own threads; a lone query is searched immediately,
+    # and queries that pile up while a search is running share the next call.
+
+    def __init__(self, index, k):
+        self.index = index
+        self.k = k
+        self.queue = collections.deque()
+        self.pending = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def search(self, query_vec):
+        future = Future()
+        self.queue.append((query_vec.astype(np.float32).reshape(-1), future))
+        self.pending.set()
+        try:
+            return future.result(timeout=SEARCH_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            future.cancel()
+            raise RuntimeError(f"Index search timed out after {SEARCH_TIMEOUT_SECONDS}s") from None
+
+    def _run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            batch = []
+            while self.queue and len(batch) < BATCH_MAX_QUERIES:
+                query_vec, future = self.queue.popleft()
+                # Skip queries whose caller already timed out.
+                if future.set_running_or_notify_cancel():
+                    batch.append((query_vec, future))
+            if self.queue:
+                self.pending.set()
+            if batch:
+                self._search_batch(batch)
+
+    def _search_batch(self, batch):
+        try:
+            scores, I = self.index.search(np.stack([q for q, _ in batch]), self.k)
+        except Exception as e:
+            logging.exception("Batched index search failed")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for row, (_, future) in enumerate(batch):
+            # FAISS pads with -1 when it finds fewer than k neighbours.
+            found = I[row] >= 0
+            future.set_result((scores[row][found], I[row][found]))
+
+@st.cache_resource(show_spinner=False)
+def get_query_batcher():
+    # One extra slot for the reference card, which is its own nearest neighbour.
+    return QueryBatcher(load_index(), TOP_K + 1)
+
+def preload_data():
     try:
-        cards = fetch_cards()
-        embeddings = np.load(os.path.join(CACHE_DIR, "embeddings_trimmed.npy"))
-        index = faiss.read_index(os.path.join(CACHE_DIR, "faiss_trimmed.index"))
-        return cards, embeddings, index
+        load_data()
+        get_query_batcher()
     except Exception as e:
-        logging.exception("Failed during data loading")
-        st.error("❌ Failed to load cache files or embeddings.")
-        st.stop()
+        logging.warning(f"Background preload failed: {e}")
+
+@st.cache_resource(show_spinner=False)
+def start_preload():
+    # Once per process: build the caches while the first user is still typing.
+    thread = threading.Thread(target=preload_data, daemon=True)
+    thread.start()
+    return thread
 
 def try_get_card_text_from_name(name):
     try:
-        url = f"https://api.scryfall.com/cards/named?fuzzy={name}"
-        res = requests.get(url)
-        if res.status_code == 200:
-            card = res.json()
+        card = fetch_scryfall_card(name)
+        if card:
             return get_card_text(card), card
     except Exception as e:
         logging.warning(f"Scryfall lookup failed for name '{name}': {e}")
@@ -109,9 +307,7 @@ def main():
     search_button = st.button("🔍 Search")
 
     validate_cache_files()
-
-    with st.spinner("🔁 Loading prebuilt data..."):
-        cards, embeddings, index = load_data()
+    preload = start_preload()
 
     color_options = ["W", "U", "B", "R", "G", "C"]
     color_labels = {
@@ -120,14 +316,25 @@ def main():
     }
 
     with st.expander("🎨 Filter by Color Identity", expanded=True):
-        selected_colors = []
+        color_mask = 0
         cols = st.columns(len(color_options))
         for i, color in enumerate(color_options):
             if cols[i].checkbox(color_labels[color], value=True):
-                selected_colors.append(color)
+                color_mask |= COLOR_BITS[color]
 
     if query and search_button:
         logging.info(f"User submitted query: '{query}'")
+        with st.spinner("🔁 Loading prebuilt data..."):
+            # Wait for the preload rather than racing it to build the same files.
+            preload.join()
+            try:
+                cards, embeddings, id_to_idx, color_bits = load_data()
+                batcher = get_query_batcher()
+            except Exception as e:
+                logging.exception("Failed during data loading")
+                st.error("❌ Failed to load cache files or embeddings.")
+                st.stop()
+
         with st.spinner("🔍 Searching..."):
             try:
                 resolved_text, resolved_card = try_get_card_text_from_name(query)
@@ -138,54 +345,45 @@ def main():
 
                 query_text = get_card_text(resolved_card)
 
-                try:
-                    ref_index = next(i for i, c in enumerate(cards) if c["id"] == resolved_card["id"])
-                    query_vec = embeddings[ref_index].reshape(1, -1)
-                    query_vec /= np.linalg.norm(query_vec)
-                except StopIteration:
+                ref_index = id_to_idx.get(resolved_card["id"])
+                if ref_index is None:
                     st.error("❌ Couldn't find prebuilt embedding for this card.")
                     logging.warning(f"No embedding for card: {resolved_card.get('name')}")
                     return
+                query_vec = embeddings[ref_index]
 
-                scores, I = index.search(query_vec, 200)
-                results = [
-                    (score, cards[idx])
-                    for score, idx in zip(scores[0], I[0])
-                    if score >= SIMILARITY_THRESHOLD and cards[idx].get("id") != resolved_card.get("id")
-                ]
-
-                def matches_color(card):
-                    identity = card.get("color_identity", [])
-                    if "C" in selected_colors:
-                        return (not identity and "C" in selected_colors) or any(c in identity for c in selected_colors if c != "C")
-                    return any(c in identity for c in selected_colors)
+                scores, I = batcher.search(query_vec)
+                not_self = I != ref_index
+                scores, I = scores[not_self][:TOP_K], I[not_self][:TOP_K]
 
-                if selected_colors:
-                    results = [(score, card) for score, card in results if matches_color(card)]
+                keep = scores >= SIMILARITY_THRESHOLD
+                # Colorless cards carry the "C" bit, so one AND covers every selection.
+                if color_mask:
+                    keep &= (color_bits[I] & color_mask) != 0
+                scores, I = scores[keep], I[keep]
 
-                if not results:
+                if not I.size:
                     st.warning("😕 No sufficiently similar cards found.")
                     logging.info("No similar cards found.")
                 else:
                     cols = st.columns(5)
                     if resolved_card:
                         with cols[0]:
-                            image_url = resolved_card.get("image_uris", {}).get("normal")
-                            if not image_url and "card_faces" in resolved_card:
-                                image_url = resolved_card["card_faces"][0].get("image_uris", {}).get("normal")
+                            image_url = get_image_uris(resolved_card).get(REFERENCE_IMAGE_SIZE)
                             if image_url:
-                                st.image(image_url, use_container_width=True)
+                                st.image(image_url, width="stretch")
                             st.markdown(f"[**{resolved_card.get('name', 'Unknown Card')}**]({resolved_card.get('scryfall_uri', '#')})")
                             st.markdown("**Similarity:** `1.000`")
 
-                    for i, (score, card) in enumerate(results):
+                    # Card fields are only gathered here, one tile at a time.
+                    for i, (score, idx) in enumerate(zip(scores.tolist(), I.tolist())):
                         with cols[(i + 1) % 5]:
-                            image_url = card.get("image_uris", {}).get("normal")
-                            if not image_url and "card_faces" in card:
-                                image_url = card["card_faces"][0].get("image_uris", {}).get("normal")
+                            image_url = cards["image_url"][idx]
                             if image_url:
-                                st.image(image_url, use_container_width=True)
-                            st.markdown(f"[**{card.get('name', 'Unknown Card')}**]({card.get('scryfall_uri', '#')})")
+                                st.image(image_url, width=IMAGE_WIDTH)
+                            name = cards["name"][idx] or "Unknown Card"
+                            scryfall_uri = cards["scryfall_uri"][idx] or "#"
+                            st.markdown(f"[**{name}**]({scryfall_uri})")
                             st.markdown(f"**Similarity:** `{score:.3f}`")
 
             except Exception as e: